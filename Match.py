@@ -27,6 +27,129 @@ class Match:
         return 2 if server == 1 else 1
 
 
+class ScoreDistribution:
+    '''
+    Joint distribution over the final score of a match.
+
+    probabilities[s1, s2, g1, g2] is the probability that the match ends
+    s1 sets to s2 with player 1 winning g1 games and player 2 winning g2
+    games in total (a tiebreak counts as one game). Every market is derived
+    from this one array so pricing never needs another sampling loop.
+
+    When sampled, trials is the number of simulated matches and interval_width
+    is the widest confidence interval over every probability in
+    market_probabilities, i.e. the precision of every price markets() returns.
+    Both are None when the distribution was computed exactly.
+    '''
+    def __init__(self, probabilities, trials = None, interval_width = None):
+        self.probabilities = probabilities
+        self.trials = trials
+        self.interval_width = interval_width
+        self.sets_to_win = probabilities.shape[0] - 1
+        self.max_games = probabilities.shape[2] - 1
+
+        #Marginal over games won by each player, regardless of set score
+        self.games = probabilities.sum(axis=(0, 1))
+
+    def match_win_probability(self) -> float:
+        '''
+        Probability that player 1 wins the match
+        '''
+        return float(self.probabilities[self.sets_to_win].sum())
+
+    def set_scores(self) -> dict:
+        '''
+        Returns dictionary mapping (sets won by 1, sets won by 2) to probability
+        '''
+        set_probabilities = self.probabilities.sum(axis=(2, 3))
+        return {(int(s1), int(s2)): float(set_probabilities[s1][s2]) for s1, s2 in np.argwhere(set_probabilities > 0)}
+
+    def total_games(self):
+        '''
+        Returns (totals, probabilities) where probabilities[i] is the
+        probability that totals[i] games are played in the match
+        '''
+        g1, g2 = np.indices(self.games.shape)
+        totals = np.arange(2*self.max_games + 1)
+        return totals, np.bincount((g1 + g2).ravel(), weights=self.games.ravel(), minlength=len(totals))
+
+    def game_margins(self):
+        '''
+        Returns (margins, probabilities) where probabilities[i] is the
+        probability that player 1 wins margins[i] more games than player 2
+        '''
+        g1, g2 = np.indices(self.games.shape)
+        margins = np.arange(-self.max_games, self.max_games + 1)
+        return margins, np.bincount((g1 - g2 + self.max_games).ravel(), weights=self.games.ravel(), minlength=len(margins))
+
+    def over_probability(self, line) -> float:
+        '''
+        Probability that more than line total games are played.
+        At a whole number line exactly line games is a push and is NOT
+        counted here, see total_push_probability.
+        '''
+        totals, probabilities = self.total_games()
+        return float(probabilities[totals > line].sum())
+
+    def total_push_probability(self, line) -> float:
+        '''
+        Probability that exactly line total games are played
+        (always 0 for half lines)
+        '''
+        totals, probabilities = self.total_games()
+        return float(probabilities[totals == line].sum())
+
+    def handicap_probability(self, line) -> float:
+        '''
+        Probability that player 1 covers a game handicap of line
+        (e.g. -3.5 means player 1 must win by 4 or more games).
+        At a whole number line a margin of exactly -line is a push and is
+        NOT counted here, see handicap_push_probability.
+        '''
+        margins, probabilities = self.game_margins()
+        return float(probabilities[margins + line > 0].sum())
+
+    def handicap_push_probability(self, line) -> float:
+        '''
+        Probability that player 1 wins by exactly -line games
+        (always 0 for half lines)
+        '''
+        margins, probabilities = self.game_margins()
+        return float(probabilities[margins + line == 0].sum())
+
+    def market_probabilities(self):
+        '''
+        Every probability markets() can price: match winner, each set score,
+        P(more than t games) / P(margin more than m) for every t and m, and
+        P(exactly t games) / P(margin exactly m) for pushes.
+        '''
+        totals, total_probabilities = self.total_games()
+        margins, margin_probabilities = self.game_margins()
+        return np.concatenate(([self.match_win_probability()],
+                               self.probabilities.sum(axis=(2, 3)).ravel(),
+                               np.cumsum(total_probabilities[::-1])[::-1],
+                               np.cumsum(margin_probabilities[::-1])[::-1],
+                               total_probabilities,
+                               margin_probabilities))
+
+    def markets(self, total_lines = (), handicap_lines = ()) -> dict:
+        '''
+        Prices every derived market at once.
+        'over' maps each of total_lines to the probability of more games than
+        the line, 'handicap' maps each of handicap_lines to the probability
+        that player 1 covers it, and 'total_push' / 'handicap_push' hold the
+        push probability at each line. total_games and game_handicap hold the
+        full distributions for any other lines.
+        '''
+        return {'match_winner': self.match_win_probability(),
+                'set_score': self.set_scores(),
+                'over': {line: self.over_probability(line) for line in total_lines},
+                'total_push': {line: self.total_push_probability(line) for line in total_lines},
+                'handicap': {line: self.handicap_probability(line) for line in handicap_lines},
+                'handicap_push': {line: self.handicap_push_probability(line) for line in handicap_lines},
+                'total_games': self.total_games(),
+                'game_handicap': self.game_margins()}
+
 
 
 class ServerChainSimulator(Match):
@@ -169,7 +292,236 @@ class ServerChainSimulator(Match):
             if interval_width <= max_width and idx > min_trials:
                 return p, interval_width
 
-        
+    def tiebreak_win_probability(self, pts, serve_order) -> float:
+        '''
+        Exact counterpart of simulate_tiebreak.
+        Returns probability that player 1 wins the tiebreak.
+        Raises ZeroDivisionError if the tiebreak can never end.
+        '''
+        serve = {idx: self.players[idx].point_win_probability['s'] for idx in self.players}
+
+        #Once tied at pts-1 each pair of points has one serve per player,
+        #so the rest of the tiebreak is a geometric race to a 2 point lead
+        win_pair = serve[1] * (1 - serve[2])
+        lose_pair = (1 - serve[1]) * serve[2]
+        if win_pair + lose_pair == 0:
+            raise ZeroDivisionError("Tiebreak never ends with these point win probabilities")
+        deuce_win = win_pair / (win_pair + lose_pair)
+
+        reach = np.zeros((pts, pts))
+        reach[0][0] = 1
+        win = 0
+        for a, b in itertools.product(range(pts), repeat = 2):
+            if a == pts - 1 and b == pts - 1:
+                win += reach[a][b] * deuce_win
+                continue
+
+            #First point is served by serve_order, then servers alternate every two points
+            server_idx = serve_order if ((a + b + 1)//2)%2 == 0 else self._other_player(serve_order)
+            q = serve[1] if server_idx == 1 else 1 - serve[2]
+
+            if a + 1 == pts:
+                win += reach[a][b] * q
+            else:
+                reach[a + 1][b] += reach[a][b] * q
+
+            if b + 1 < pts:
+                reach[a][b + 1] += reach[a][b] * (1 - q)
+
+        return win
+
+    def set_score_distribution(self, serve_order):
+        '''
+        Exact counterpart of simulate_set.
+        Returns 8x8 array where entry [g1, g2] is the probability
+        that the set ends g1 games to g2.
+        '''
+        hold = {idx: self.players[idx].game_win_probability(is_server = True) for idx in self.players}
+
+        reach = np.zeros((8, 8))
+        reach[0][0] = 1
+        distribution = np.zeros((8, 8))
+        for g1, g2 in itertools.product(range(7), repeat = 2):
+            if g1 == 6 and g2 == 6:
+                tiebreak = self.tiebreak_win_probability(7, serve_order)
+                distribution[7][6] += reach[g1][g2] * tiebreak
+                distribution[6][7] += reach[g1][g2] * (1 - tiebreak)
+                continue
+
+            server_idx = serve_order if (g1 + g2)%2 == 0 else self._other_player(serve_order)
+            q = hold[1] if server_idx == 1 else 1 - hold[2]
+
+            for (n1, n2), p in (((g1 + 1, g2), q), ((g1, g2 + 1), 1 - q)):
+                if (n1 >= 6 and n1 - n2 >= 2) or (n2 >= 6 and n2 - n1 >= 2):
+                    distribution[n1][n2] += reach[g1][g2] * p
+                else:
+                    reach[n1][n2] += reach[g1][g2] * p
+
+        return distribution
+
+    def exact_score_distribution(self) -> ScoreDistribution:
+        '''
+        Exact counterpart of simulate_match. Chains set score distributions
+        together, tracking sets and games won by each player.
+
+        Raises np.linalg.LinAlgError or ZeroDivisionError if a game or tiebreak
+        can never end, and ValueError if the result is not a valid distribution.
+        '''
+        max_games = 7 * (2*self.sets_to_win - 1)
+        set_distributions = {idx: self.set_score_distribution(idx) for idx in self.players}
+
+        probabilities = np.zeros((self.sets_to_win + 1, self.sets_to_win + 1, max_games + 1, max_games + 1))
+
+        #reach[(s1, s2, server_idx)] is an array over games won by each player so far
+        start = np.zeros((max_games + 1, max_games + 1))
+        start[0][0] = 1
+        reach = {(0, 0, 1): start}
+
+        for sets_played in range(2*self.sets_to_win - 1):
+            for key in [key for key in reach if key[0] + key[1] == sets_played]:
+                s1, s2, server_idx = key
+                games = reach.pop(key)
+                set_distribution = set_distributions[server_idx]
+
+                for g1, g2 in np.argwhere(set_distribution > 0):
+                    shifted = np.zeros_like(games)
+                    shifted[g1:, g2:] = games[:max_games + 1 - g1, :max_games + 1 - g2] * set_distribution[g1][g2]
+
+                    n1, n2 = (s1 + 1, s2) if g1 > g2 else (s1, s2 + 1)
+                    if n1 == self.sets_to_win or n2 == self.sets_to_win:
+                        probabilities[n1][n2] += shifted
+                    else:
+                        #Same serve rotation as simulate_match
+                        next_server = 1 if (g1 + g2)%2 == 0 else 2
+                        next_key = (n1, n2, next_server)
+                        reach[next_key] = reach.get(next_key, 0) + shifted
+
+        if not np.isfinite(probabilities).all() or not np.isclose(probabilities.sum(), 1):
+            raise ValueError(f"Exact score distribution is invalid (total probability {probabilities.sum()})")
+
+        return ScoreDistribution(probabilities)
+
+    def simulate_tiebreaks(self, pts, serve_order):
+        '''
+        Vectorized counterpart of simulate_tiebreak. serve_order is an array
+        with the first server of each tiebreak.
+
+        Returns array with the winner of each tiebreak
+        '''
+        serve = {idx: self.players[idx].point_win_probability['s'] for idx in self.players}
+
+        n = len(serve_order)
+        score = {1: np.zeros(n, dtype=int), 2: np.zeros(n, dtype=int)}
+        winner = np.zeros(n, dtype=int)
+        while (winner == 0).any():
+            #First point is served by serve_order, then servers alternate every two points.
+            #3 - idx is the vectorized _other_player
+            server_idx = np.where(((score[1] + score[2] + 1)//2)%2 == 0, serve_order, 3 - serve_order)
+            p = np.where(server_idx == 1, serve[1], serve[2])
+            point_winner = np.where(np.random.random(n) < p, server_idx, 3 - server_idx)
+
+            for idx in self.players:
+                score[idx] += (winner == 0) & (point_winner == idx)
+            for idx in self.players:
+                won = (winner == 0) & (score[idx] >= pts) & (score[idx] - score[3 - idx] >= 2)
+                winner[won] = idx
+
+        return winner
+
+    def simulate_matches(self, n):
+        '''
+        Vectorized counterpart of simulate_match. Simulates n matches at once,
+        stepping every unfinished match forward one game at a time.
+
+        Returns arrays (sets won by 1, sets won by 2, games won by 1, games won by 2)
+        '''
+        sets = {1: np.zeros(n, dtype=int), 2: np.zeros(n, dtype=int)}
+        games = {1: np.zeros(n, dtype=int), 2: np.zeros(n, dtype=int)}
+        set_games = {1: np.zeros(n, dtype=int), 2: np.zeros(n, dtype=int)}
+        set_server = np.ones(n, dtype=int)
+        active = np.ones(n, dtype=bool)
+
+        while active.any():
+            g1, g2 = set_games[1], set_games[2]
+            tiebreak = active & (g1 == 6) & (g2 == 6)
+            playing = active & ~tiebreak
+
+            game_winner = np.zeros(n, dtype=int)
+            server_idx = np.where((g1 + g2)%2 == 0, set_server, 3 - set_server)
+            for idx in self.players:
+                serving = playing & (server_idx == idx)
+                holds = self.players[idx].simulate_games(serving.sum(), is_server = True)
+                game_winner[serving] = np.where(holds, idx, 3 - idx)
+            if tiebreak.any():
+                game_winner[tiebreak] = self.simulate_tiebreaks(7, set_server[tiebreak])
+
+            for idx in self.players:
+                set_games[idx] += game_winner == idx
+                games[idx] += game_winner == idx
+
+            g1, g2 = set_games[1], set_games[2]
+            set_over = tiebreak | (playing & (((g1 >= 6) & (g1 - g2 >= 2)) | ((g2 >= 6) & (g2 - g1 >= 2))))
+            for idx in self.players:
+                sets[idx] += set_over & (set_games[idx] > set_games[3 - idx])
+
+            #Same serve rotation as simulate_match
+            set_server[set_over] = np.where((g1 + g2)[set_over]%2 == 0, 1, 2)
+            for idx in self.players:
+                set_games[idx][set_over] = 0
+
+            active &= (sets[1] < self.sets_to_win) & (sets[2] < self.sets_to_win)
+
+        return sets[1], sets[2], games[1], games[2]
+
+    def sample_score_distribution(self, confidence_level = 0.95, max_width = 0.01, min_trials = 30, batch_size = 1000, max_trials = 1000000) -> ScoreDistribution:
+        '''
+        Monte Carlo counterpart of exact_score_distribution. Simulates batches
+        of batch_size matches with simulate_matches until the widest confidence
+        interval over market_probabilities (every price markets() returns) is at
+        most max_width, or until max_trials matches have been simulated.
+
+        Raises np.linalg.LinAlgError or ZeroDivisionError if a game or tiebreak
+        can never end, since no simulated match would ever finish.
+        '''
+        for idx in self.players:
+            self.players[idx].game_win_probability(is_server = True)
+        self.tiebreak_win_probability(7, 1)
+
+        z = norm.ppf(confidence_level + (1-confidence_level)/2)
+
+        max_games = 7 * (2*self.sets_to_win - 1)
+        counts = np.zeros((self.sets_to_win + 1, self.sets_to_win + 1, max_games + 1, max_games + 1))
+        trials = 0
+        while True:
+            n = min(batch_size, max_trials - trials)
+            s1, s2, g1, g2 = self.simulate_matches(n)
+            np.add.at(counts, (s1, s2, g1, g2), 1)
+            trials += n
+
+            distribution = ScoreDistribution(counts/trials, trials = trials)
+            p = distribution.market_probabilities()
+            distribution.interval_width = float(z * np.sqrt(np.max(p * (1-p))/trials))
+
+            if distribution.interval_width <= max_width and trials > min_trials:
+                return distribution
+
+            if trials >= max_trials:
+                self.logger.warning(f"Reached {trials} trials with interval width {distribution.interval_width:.5f}. Returning sampled distribution.")
+                return distribution
+
+    def score_distribution(self, exact = True, confidence_level = 0.95, max_width = 0.01, min_trials = 30, batch_size = 1000, max_trials = 1000000) -> ScoreDistribution:
+        '''
+        Full distribution of set score and games won. Computed exactly by
+        exact_score_distribution, or sampled by sample_score_distribution
+        when exact is False (the remaining arguments only apply then).
+
+        Matches that can never finish raise np.linalg.LinAlgError or
+        ZeroDivisionError either way.
+        '''
+        if exact:
+            return self.exact_score_distribution()
+
+        return self.sample_score_distribution(confidence_level, max_width, min_trials, batch_size, max_trials)
 
 def t_simulate_set(name_1, name_2):
     '''
@@ -251,6 +603,26 @@ def t_sample_match_distribution(name_1, name_2):
     logger.info(f"Probability of player 1 winning the match is {p:.3f} +- {interval:.5f}")
 
 
+def t_score_distribution(name_1, name_2):
+    from PlayerDB import PlayerDB
+
+    db = PlayerDB()
+    db.populate_from_csv('tennis_pointbypoint/pbp_matches_atp_main_current.csv')
+
+    player_1 = db.get_player_mc(name_1)
+    player_2 = db.get_player_mc(name_2)
+
+    simulator = ServerChainSimulator(player_1, player_2, match_format='grand slam')
+    markets = simulator.score_distribution().markets(total_lines = [38.5], handicap_lines = [-4.5])
+
+    logger.info(f"Probability of player 1 winning the match is {markets['match_winner']:.3f}")
+    logger.info(f"Set scores: {markets['set_score']}")
+
+    totals, probabilities = markets['total_games']
+    logger.info(f"Expected total games is {(totals * probabilities).sum():.2f}")
+    logger.info(f"Over 38.5 games: {markets['over'][38.5]:.3f}, {name_1} -4.5 games: {markets['handicap'][-4.5]:.3f}")
+
+
 if __name__ == '__main__':
     logger = logging.getLogger('Match.py')
     logger.setLevel(logging.DEBUG)
@@ -261,4 +633,5 @@ if __name__ == '__main__':
     #t_simulate_set('Roger Federer', 'John Isner')
     t_simulate_match('Roger Federer', 'John Isner')
     #t_inspect_distribution('Serena Williams', 'Fangzhou Liu', 1000)
-    #t_sample_match_distribution('Roger Federer', 'Rafael Nadal')
\ No newline at end of file
+    #t_sample_match_distribution('Roger Federer', 'Rafael Nadal')
+    #t_score_distribution('Roger Federer', 'Rafael Nadal')
\ No newline at end of file
@@ -14,6 +14,10 @@ STATE_MAPPING = {0:'0 - 0', 1:'15 - 0', 2:'0 - 15', 3:'30 - 0', 4:'15 - 15', 5:'
                 12:'15 - 40', 13:'40 - 30', 14:'30 - 40', 15:'40 - 40', 16:'Ad - 40', 17:'40 - Ad',
                 18:'W', 19:'L'}
 
+#Array form of STATE_TRANSITIONS for simulating many games at once
+WIN_NEXT = np.array([STATE_TRANSITIONS[state][0] for state in range(20)])
+LOSE_NEXT = np.array([STATE_TRANSITIONS[state][1] for state in range(20)])
+
 class PlayerMC:
     '''
     Mostly just a container class for the matrix representation
@@ -32,6 +36,10 @@ class PlayerMC:
         self.logger = logging.getLogger("PlayerMC")
         self.logger.setLevel(logging.WARNING)
         self.logger.addHandler(ch)
+
+        #Matrices actually used to play games, rebuilt whenever the counts change
+        self.filled_matrices = {'s': None, 'r': None}
+        self._compute_filled_matrices()
     
     def get_player_serve_probabilities(self):
         return self.transition_matrices['s']
@@ -78,6 +86,7 @@ class PlayerMC:
             #self.logger.debug(f"At the end of update, transition counts are {self.transition_counts}")
             self._compute_transition_matrices()
             self._compute_point_win_probability()
+            self._compute_filled_matrices()
     
     def _compute_point_win_probability(self) -> float:
         '''
@@ -115,6 +124,26 @@ class PlayerMC:
                     sums[idx][0] = 1
             self.transition_matrices[selector] = self.transition_counts[selector]/sums
 
+    def _compute_filled_matrices(self):
+        '''
+        Copies of the serve and return matrices where rows with no observed
+        points use the total win percent on s/r approximation.
+        Shared by simulate_game, simulate_games and game_win_probability
+        so sampled and exact results agree.
+        '''
+        for selector in ['s', 'r']:
+            matrix = self.transition_matrices[selector].copy()
+
+            #p is always the probability that the SERVER wins the point
+            p = self.point_win_probability['s'] if selector == 's' else 1 - self.point_win_probability['r']
+            for state in range(18):
+                if not np.isclose(np.sum(matrix[state]), 1):
+                    matrix[state] = 0
+                    matrix[state][STATE_TRANSITIONS[state][0]] = p
+                    matrix[state][STATE_TRANSITIONS[state][1]] = 1 - p
+
+            self.filled_matrices[selector] = matrix
+
     def simulate_game(self, is_server=True) -> bool:
         '''
         Simulates a single game of player serving.
@@ -122,28 +151,11 @@ class PlayerMC:
         Returns True if player wins, False otherwise
         '''
         choices = np.arange(20)
+        matrix = self.filled_matrices['s' if is_server else 'r']
         state = 0
         path = ""
         while True:
-            if is_server:
-                probabilities = self.transition_matrices['s'][state]
-            else:
-                probabilities = self.transition_matrices['r'][state]
-
-            if np.sum(probabilities) != 1:
-                self.logger.error(f"Player {self.player_name}: Probabilities do not sum to 1. Printing row of transition matrix")
-                self.logger.error(f"{probabilities}, (state {state})")
-
-                self.logger.warning(f"Using total win percent on s/r approximation.")
-
-                if is_server:
-                    p = self.point_win_probability['s']
-                else:
-                    p = self.point_win_probability['r']
-                probabilities[STATE_TRANSITIONS[state][0]] = p
-                probabilities[STATE_TRANSITIONS[state][1]] = 1 - p
-
-            next_state = np.random.choice(choices, p = probabilities)
+            next_state = np.random.choice(choices, p = matrix[state])
 
             path += f"{STATE_MAPPING[next_state]}, "
 
@@ -154,6 +166,41 @@ class PlayerMC:
 
             state = next_state
 
+    def simulate_games(self, n, is_server=True):
+        '''
+        Vectorized counterpart of simulate_game. Simulates n games at once.
+
+        Returns boolean array, True where player wins
+        '''
+        matrix = self.filled_matrices['s' if is_server else 'r']
+
+        state = np.zeros(n, dtype=int)
+        playing = state < 18
+        while playing.any():
+            current = state[playing]
+            server_wins = np.random.random(len(current)) < matrix[current, WIN_NEXT[current]]
+            state[playing] = np.where(server_wins, WIN_NEXT[current], LOSE_NEXT[current])
+            playing = state < 18
+
+        return state == 18 if is_server else state == 19
+
+    def game_win_probability(self, is_server=True) -> float:
+        '''
+        Exact counterpart of simulate_game. Solves for the absorption
+        probabilities of the chain instead of sampling paths through it.
+
+        Returns probability that player wins the game.
+        Raises np.linalg.LinAlgError if the chain can never leave deuce.
+        '''
+        matrix = self.filled_matrices['s' if is_server else 'r']
+
+        #States 0-17 are transient, 18 and 19 are absorbing
+        transient = matrix[:18, :18]
+        absorbing = matrix[:18, 18:]
+        absorption = np.linalg.solve(np.eye(18) - transient, absorbing)
+
+        return float(absorption[0][0] if is_server else absorption[0][1])
+
     def simulate_point(self, is_server=True) -> bool:
         '''
         Uses the total probability of winning on serve to simulate a single point.